@@ -0,0 +1,249 @@
+#!/usr/bin/env python2
+####################
+# L2L Library Benchmark
+# Runs the read and write paths of the L2L Ignition Scripting Library against the offline mock API server under a plain
+# Python 2.7 interpreter (see ignition_shim.py and l2l_mock_server.py) and reports calls/sec, latency percentiles and memory.
+# Runs are reproducible: the mock dataset is seeded and the latency and error rates are set on the command line.
+# Command line examples:
+# 		python2 tools/benchmark.py
+# 		python2 tools/benchmark.py --transport systemnet,pooled --latency 0.02 --threads 8 --count 2000
+# 		python2 tools/benchmark.py --transport pooled,uncompressed --bandwidth 250000 --machines 50 --path read
+# 		python2 tools/benchmark.py --scenario get_machines,increment_cycle_count --json results.json
+####################
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ignition_shim
+import l2l_mock_server
+
+
+def percentile(ordered, fraction):
+	""" Nearest rank percentile of a sorted list """
+	if not ordered:
+		return 0.0
+	return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def max_rss_kb():
+	""" Peak resident set size of this process in KB, None where the resource module is missing """
+	if resource is None:
+		return None
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+def rss_kb():
+	""" Current resident set size of this process in KB, None where /proc/self/statm is missing """
+	try:
+		with open('/proc/self/statm') as f:
+			pages = int(f.read().split()[1])
+	except (IOError, OSError, ValueError, IndexError):
+		return None
+	return pages * os.sysconf('SC_PAGE_SIZE') / 1024
+
+
+####################
+# Scenarios
+# Each scenario is (name, path, setup) where setup(L2L, l2l, machines) returns (call(i), finish()). call runs count times
+# across the worker threads, finish (or None) runs once afterwards and is included in the elapsed time. setup is not timed.
+####################
+def _get_machines(L2L, l2l, machines):
+	return (lambda i: l2l.get_machines()), None
+
+
+def _get_machines_fields(L2L, l2l, machines):
+	return (lambda i: l2l.get_machines(fields=('id', 'code', 'externalid'))), None
+
+
+def _iter_machines(L2L, l2l, machines):
+	return (lambda i: sum(1 for m in l2l.iter_machines())), None
+
+
+def _get_machine_by_code(L2L, l2l, machines):
+	return (lambda i: l2l.get_machines(machinecode=machines[i % len(machines)])), None
+
+
+def _master_data_cache(L2L, l2l, machines):
+	cache = L2L.L2L_MasterDataCache(l2l.site)
+	for code in machines:		# Warm up, the scenario measures cache hits
+		cache.get(l2l, 'machines', code=code)
+	return (lambda i: cache.get(l2l, 'machines', code=machines[i % len(machines)])), None
+
+
+def _increment_cycle_count(L2L, l2l, machines):
+	return (lambda i: l2l.increment_cycle_count(machines[i % len(machines)], 1)), None
+
+
+def _cycle_count_buffer(L2L, l2l, machines):
+	buffer = L2L.L2L_CycleCountBuffer()
+	return (lambda i: buffer.increment(machines[i % len(machines)], 1)), (lambda: buffer.flush(l2l, force=True))
+
+
+def _record_pitch_details(L2L, l2l, machines):
+	start = datetime(2021, 11, 1, 6, 0, 0)
+	def call(i):
+		begin = start + timedelta(hours=i)
+		return l2l.record_pitch_details("S1-A0-L0", None, begin, begin + timedelta(hours=1), "P1", 100, 2, 3)
+	return call, None
+
+
+def _open_dispatch(L2L, l2l, machines):
+	index = L2L.L2L_DispatchIndex()
+	dispatchtypecode = "Benchmark %d" % id(index)		# New dispatch type per run, the mock keeps earlier dispatches open
+	return (lambda i: index.open(l2l, dispatchtypecode, "Benchmark", machines[i % len(machines)])), None
+
+
+SCENARIOS = [
+	('get_machines', 'read', _get_machines),
+	('get_machines_fields', 'read', _get_machines_fields),
+	('iter_machines', 'read', _iter_machines),
+	('get_machine_by_code', 'read', _get_machine_by_code),
+	('master_data_cache', 'read', _master_data_cache),
+	('increment_cycle_count', 'write', _increment_cycle_count),
+	('cycle_count_buffer', 'write', _cycle_count_buffer),
+	('record_pitch_details', 'write', _record_pitch_details),
+	('open_dispatch', 'write', _open_dispatch),
+]
+
+
+def run_scenario(L2L, l2l, machines, setup, count, threads, wire_bytes=None):
+	""" Run one scenario and return its measurements. wire_bytes() returns the bytes the server has sent so far. """
+	call, finish = setup(L2L, l2l, machines)
+	latencies = []
+	errors = [0]
+	lock = threading.Lock()
+	counter = iter(xrange(count))
+
+	def worker():
+		local = []
+		while True:
+			with lock:
+				i = next(counter, None)
+			if i is None:
+				break
+			started = time.time()
+			try:
+				call(i)
+			except:
+				with lock:
+					errors[0] += 1
+			local.append(time.time() - started)
+		with lock:
+			latencies.extend(local)
+
+	gc.collect()
+	objects_before = len(gc.get_objects())
+	rss_before = rss_kb()
+	bytes_before = wire_bytes() if wire_bytes is not None else None		# After the setup, its warm-up traffic is not counted
+	started = time.time()
+	workers = [threading.Thread(target=worker) for n in range(threads)]
+	for thread in workers:
+		thread.start()
+	for thread in workers:
+		thread.join()
+	if finish is not None:
+		finish()
+	elapsed = time.time() - started
+	bytes_after = wire_bytes() if wire_bytes is not None else None
+	gc.collect()
+
+	latencies.sort()
+	rss_after = rss_kb()
+	return {
+		'calls': count,
+		'errors': errors[0],
+		'seconds': round(elapsed, 3),
+		'calls_per_sec': round(count / elapsed, 1) if elapsed > 0 else 0.0,
+		'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+		'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+		'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+		'max_rss_kb': max_rss_kb(),
+		'rss_growth_kb': rss_after - rss_before if rss_after is not None and rss_before is not None else None,
+		'objects_growth': len(gc.get_objects()) - objects_before,
+		'wire_kb': (bytes_after - bytes_before) / 1024 if bytes_after is not None else None,		# Response bodies as sent
+	}
+
+
+def make_connection(L2L, url, transport):
+	""" L2L_Connection to the mock server with the named transport """
+	if transport == 'pooled':
+		backend = L2L.L2L_PooledHTTPTransport(base_url=url)
+	elif transport == 'nokeepalive':
+		backend = L2L.L2L_PooledHTTPTransport(base_url=url, keep_alive=False)
+	elif transport == 'uncompressed':
+		backend = L2L.L2L_PooledHTTPTransport(base_url=url, accept_encoding="")
+	else:
+		backend = L2L.L2L_SystemNetTransport()
+	l2l = L2L.L2L_Connection("mock", "benchmark", 1, "benchmark", transport=backend)
+	l2l.circuit_breaker = None
+	return l2l
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the L2L Ignition Scripting Library against the offline mock API server")
+	parser.add_argument('--count', type=int, default=500, help="calls per scenario")
+	parser.add_argument('--threads', type=int, default=4, help="concurrent callers")
+	parser.add_argument('--transport', default="systemnet,pooled", help="comma list of systemnet, pooled, nokeepalive, uncompressed")
+	parser.add_argument('--scenario', default=None, help="comma list of scenarios, default all: " + ", ".join(s[0] for s in SCENARIOS))
+	parser.add_argument('--path', default=None, choices=('read', 'write'), help="only run the read or write scenarios")
+	parser.add_argument('--machines', type=int, default=10, help="machines per line in the mock dataset (4 areas x 5 lines)")
+	parser.add_argument('--latency', type=float, default=0.0, help="mock server latency in seconds")
+	parser.add_argument('--jitter', type=float, default=0.0, help="mock server +/- latency jitter in seconds")
+	parser.add_argument('--bandwidth', type=int, default=0, help="mock server response bytes per second per connection, 0 is unlimited")
+	parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of mock responses that are HTTP 500")
+	parser.add_argument('--url', default=None, help="use an already running mock server instead of starting one")
+	parser.add_argument('--json', default=None, help="also write the results to this file")
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.WARNING)
+
+	server = None
+	if args.url:
+		url = args.url.rstrip('/')
+	else:
+		server = l2l_mock_server.start_server(machines=args.machines, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, bandwidth=args.bandwidth)
+		url = server.url
+	ignition_shim.redirect(url)
+	L2L = ignition_shim.load_library()
+
+	wanted = args.scenario.split(',') if args.scenario else [s[0] for s in SCENARIOS]
+	scenarios = [s for s in SCENARIOS if s[0] in wanted and (args.path is None or s[1] == args.path)]
+	results = []
+	print "%-12s %-22s %-5s %8s %8s %10s %9s %9s %9s %10s %10s" % ("transport", "scenario", "path", "calls", "errors", "calls/sec", "p50 ms", "p95 ms", "p99 ms", "mem +", "wire KB")
+	for transport in args.transport.split(','):
+		l2l = make_connection(L2L, url, transport)
+		machines = [m['code'] for m in l2l.get_machines()['data']]
+		for name, path, setup in scenarios:
+			result = run_scenario(L2L, l2l, machines, setup, args.count, args.threads, (lambda: server.bytes_sent) if server is not None else None)
+			result.update({'transport': transport, 'scenario': name, 'path': path})
+			results.append(result)
+			# RSS growth where /proc is available, otherwise the growth in live Python objects
+			memory = "%d KB" % result['rss_growth_kb'] if result['rss_growth_kb'] is not None else "%d obj" % result['objects_growth']
+			print "%-12s %-22s %-5s %8d %8d %10.1f %9.2f %9.2f %9.2f %10s %10s" % (transport, name, path, result['calls'], result['errors'],
+				result['calls_per_sec'], result['p50_ms'], result['p95_ms'], result['p99_ms'], memory, result['wire_kb'])
+		if hasattr(l2l.transport, 'close'):
+			l2l.transport.close()
+
+	if server is not None:
+		server.shutdown()
+		server.server_close()
+
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+	main()
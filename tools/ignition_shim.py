@@ -0,0 +1,223 @@
+####################
+# Ignition system Shim
+# Minimal stand-in for the Ignition system.net, system.util and system.tag functions used by the L2L Ignition Scripting
+# Library, so code.py can be loaded and exercised under a plain Python 2.7 interpreter (no Gateway, no Designer).
+# 	system.net.httpGet/httpPost		- urllib2, honours connectTimeout/readTimeout, optional redirect to a mock server
+# 	system.util.getLogger/jsonDecode/jsonEncode - logging and json
+# 	system.date.fromMillis/now					- java.util.Date stand-in
+# 	system.tag.read/readBlocking/writeBlocking/configure/queryTagHistory - in memory tag store, see TAGS and HISTORY
+# Example:
+# 		import ignition_shim, l2l_mock_server
+# 		server = l2l_mock_server.start_server()
+# 		ignition_shim.redirect(server.url)
+# 		L2L = ignition_shim.load_library()
+# 		l2l = L2L.L2L_Connection("mock", "key", 1, "user")
+####################
+import imp
+import json
+import logging
+import os
+import re
+import sys
+import time
+import urllib2
+
+
+L2L_LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+	"L2L_Ignition_Scripting_Library_2021-11-20_0942", "ignition", "script-python", "L2L", "code.py")
+
+TAGS = {"[System]Gateway/SystemName": "Ignition-Shim"}	# Tag path -> value
+HISTORY = {}											# Tag path -> [(epoch milliseconds, value), ...] for queryTagHistory
+
+_REDIRECT = {'base_url': None}
+_L2L_HOST = re.compile(r"^https?://[^/]*\.leading2lean\.com")
+
+
+class QualifiedValue(object):
+	""" Tag read result with value, quality and timestamp like Ignition's QualifiedValue """
+
+	def __init__(self, value, quality="Good"):
+		self.value = value
+		self.quality = quality
+		self.timestamp = None
+
+
+class Logger(object):
+	""" Ignition style logger on top of the logging module """
+
+	def __init__(self, name):
+		self._logger = logging.getLogger(name)
+
+	def trace(self, msg): self._logger.debug(msg)
+	def debug(self, msg): self._logger.debug(msg)
+	def info(self, msg): self._logger.info(msg)
+	def warn(self, msg): self._logger.warning(msg)
+	def error(self, msg): self._logger.error(msg)
+	def isDebugEnabled(self): return self._logger.isEnabledFor(logging.DEBUG)
+	def isTraceEnabled(self): return self._logger.isEnabledFor(logging.DEBUG)
+
+
+class _Namespace(object):
+	pass
+
+
+def redirect(base_url):
+	""" Send system.net requests for https://<server>.leading2lean.com to base_url instead, e.g. a mock server. None turns it off. 
+	Call it before load_library to also point the library's pooled transport at base_url. """
+	_REDIRECT['base_url'] = base_url.rstrip('/') if base_url else None
+
+
+def _url(url):
+	if _REDIRECT['base_url'] is not None:
+		return _L2L_HOST.sub(_REDIRECT['base_url'], url)
+	return url
+
+
+def _timeout(connectTimeout, readTimeout):
+	values = [t for t in (connectTimeout, readTimeout) if t]
+	return max(values) / 1000.0 if values else 60.0
+
+
+def httpGet(url, connectTimeout=10000, readTimeout=60000, username=None, password=None, headerValues=None, bypassCertValidation=False, useCaches=False, throwOnError=True):
+	""" system.net.httpGet """
+	request = urllib2.Request(_url(url), headers=headerValues or {})
+	return urllib2.urlopen(request, timeout=_timeout(connectTimeout, readTimeout)).read()
+
+
+def httpPost(url, contentType=None, postData=None, connectTimeout=10000, readTimeout=60000, username=None, password=None, headerValues=None, bypassCertValidation=False, throwOnError=True):
+	""" system.net.httpPost """
+	headers = dict(headerValues or {})
+	if contentType is not None:
+		headers['Content-Type'] = contentType
+	if isinstance(postData, dict):
+		postData = "&".join("%s=%s" % (urllib2.quote(str(k)), urllib2.quote(str(v))) for k, v in postData.items())
+	request = urllib2.Request(_url(url), data=postData or "", headers=headers)
+	return urllib2.urlopen(request, timeout=_timeout(connectTimeout, readTimeout)).read()
+
+
+def read(tagPath):
+	""" system.tag.read """
+	return QualifiedValue(TAGS.get(tagPath), "Good" if tagPath in TAGS else "Bad_NotFound")
+
+
+def readBlocking(tagPaths, timeout=45000):
+	""" system.tag.readBlocking """
+	return [read(path) for path in tagPaths]
+
+
+def writeBlocking(tagPaths, values, timeout=45000):
+	""" system.tag.writeBlocking """
+	for path, value in zip(tagPaths, values):
+		TAGS[path] = value
+	return ["Good" for path in tagPaths]
+
+
+def configure(basePath, tags, collisionPolicy="o"):
+	""" system.tag.configure, memory tags (and folders of them) are stored as basePath/name -> value """
+	def add(path, tag):
+		path = path.rstrip('/') + '/' + tag['name']
+		for child in tag.get('tags', []):
+			add(path, child)
+		if 'value' in tag:
+			TAGS[path] = tag['value']
+	for tag in tags:
+		add(basePath, tag)
+	return ["Good" for tag in tags]
+
+
+def queryTagHistory(paths, startDate=None, endDate=None, returnSize=-1, aggregationMode=None, returnFormat="Wide", columnNames=None, intervalHours=None, intervalMinutes=None, rangeHours=None, rangeMinutes=None, aliases=None, includeBoundingValues=False, validateSCExec=None, noInterpolation=False, ignoreBadQuality=False, timeout=None, intervalSeconds=None, rangeSeconds=None):
+	""" system.tag.queryTagHistory, the raw values between startDate and endDate from HISTORY in the Tall format """
+	start = _epoch_ms(startDate)
+	end = _epoch_ms(endDate)
+	rows = []
+	for path in paths:
+		before = None
+		for timestamp, value in sorted(HISTORY.get(path, [])):
+			if start is not None and timestamp < start:
+				before = [path, value, 192, Date(timestamp)]
+			elif end is None or timestamp < end:
+				rows.append([path, value, 192, Date(timestamp)])
+		if includeBoundingValues and before is not None:
+			rows.append(before)
+	rows.sort(key=lambda row: row[3].getTime())
+	if returnSize is not None and returnSize >= 0:
+		rows = rows[:returnSize]
+	return Dataset(["path", "value", "quality", "timestamp"], rows)
+
+
+class Date(object):
+	""" java.util.Date stand-in """
+
+	def __init__(self, millis):
+		self._millis = long(millis)
+
+	def getTime(self):
+		return self._millis
+
+	def __repr__(self):
+		return "Date(%d)" % self._millis
+
+
+class Dataset(object):
+	""" Ignition Dataset stand-in """
+
+	def __init__(self, columns, rows):
+		self._columns = list(columns)
+		self._rows = rows
+
+	def getRowCount(self):
+		return len(self._rows)
+
+	def getColumnCount(self):
+		return len(self._columns)
+
+	def getColumnNames(self):
+		return list(self._columns)
+
+	def getValueAt(self, row, column):
+		if not isinstance(column, (int, long)):
+			column = self._columns.index(column)
+		return self._rows[row][column]
+
+
+def _epoch_ms(value):
+	if value is None:
+		return None
+	if hasattr(value, 'getTime'):
+		return value.getTime()
+	if hasattr(value, 'timetuple'):
+		return long(time.mktime(value.timetuple()) * 1000)
+	return int(value)
+
+
+system = _Namespace()
+system.net = _Namespace()
+system.util = _Namespace()
+system.tag = _Namespace()
+system.date = _Namespace()
+system.net.httpGet = httpGet
+system.net.httpPost = httpPost
+system.util.getLogger = Logger
+system.util.jsonDecode = json.loads
+system.util.jsonEncode = json.dumps
+system.tag.read = read
+system.tag.readBlocking = readBlocking
+system.tag.writeBlocking = writeBlocking
+system.tag.configure = configure
+system.tag.queryTagHistory = queryTagHistory
+system.date.fromMillis = Date
+system.date.now = lambda: Date(time.time() * 1000)
+
+
+def load_library(path=None):
+	""" Load code.py as the L2L module with the shim's system in scope, like the Ignition script-python project library """
+	path = path if path is not None else L2L_LIBRARY_PATH
+	module = imp.new_module("L2L")
+	module.__file__ = path
+	module.system = system
+	module.L2L = module
+	sys.modules["L2L"] = module
+	exec compile(open(path).read(), path, "exec") in module.__dict__
+	if _REDIRECT['base_url'] is not None:
+		module.L2L_POOL_BASE_URL = _REDIRECT['base_url']
+	return module
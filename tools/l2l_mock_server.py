@@ -0,0 +1,360 @@
+#!/usr/bin/env python2
+####################
+# L2L Mock API Server
+# Offline stand-in for the L2L (Leading2Lean) API, for testing and benchmarking the L2L Ignition Scripting Library
+# without a sandbox site. Runs under a plain Python 2.7 interpreter with the standard library only.
+# Implements the endpoints the library uses:
+# 	sites/ areas/ lines/ machines/ dispatches/					- Lists with field filters, __gt/__gte/__lt/__lte filters, fields, limit and offset
+# 	machines/increment_cycle_count/ machines/set_cycle_count/	- Updates the machine cycle count
+# 	pitchdetails/record_details/								- Records a pitch detail
+# 	dispatches/open/ dispatches/close/<id>/						- Opens and closes dispatches, one open dispatch per machine and dispatch type
+# Responses of at least MOCK_COMPRESS_MIN_BYTES are gzip or deflate compressed when the request's Accept-Encoding allows it,
+# and gzip compressed request bodies (Content-Encoding: gzip) are accepted.
+# Latency, bandwidth (to stand in for a slow plant WAN link), error rate, throttle rate and dataset sizes are configurable.
+# Command line example:
+# 		python2 tools/l2l_mock_server.py --port 8080 --machines 2000 --latency 0.05 --bandwidth 250000 --error-rate 0.01
+# Python example:
+# 		server = l2l_mock_server.start_server(machines=2000, latency=0.05)
+# 		print server.url, server.stats()
+# 		server.shutdown()
+####################
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import random
+import threading
+import time
+import urlparse
+import zlib
+from datetime import datetime, timedelta
+
+
+MOCK_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+MOCK_DUPLICATE_DISPATCH_ERROR = "Machine {machinecode} already has an open dispatch of type {dispatchtypecode}"
+MOCK_RESERVED_PARAMETERS = ('auth', 'limit', 'offset', 'fields', 'format', 'skip_lastupdated')
+MOCK_LIST_APIS = ('sites', 'areas', 'lines', 'machines', 'dispatches')
+MOCK_COMPRESS_MIN_BYTES = 1024		# Smaller responses are sent uncompressed, like most web servers do
+
+
+class L2L_MockData:
+	""" In memory dataset served by the mock server. Safe to share between threads. """
+
+	def __init__(self, sites=1, areas=4, lines=5, machines=10, seed=0):
+		""" Builds sites, and areas, lines and machines per site (lines per area, machines per line) """
+		self.lock = threading.Lock()
+		self.records = dict((api, []) for api in MOCK_LIST_APIS)
+		self.pitchdetails = []
+		self.next_id = 1
+		rnd = random.Random(seed)
+		now = datetime.now().replace(microsecond=0)
+		past = lambda: now - timedelta(seconds=rnd.randint(3600, 30 * 86400))	# Records were last updated an hour to 30 days ago
+		for s in range(1, sites + 1):
+			self._add('sites', past(), site=s, code="S%d" % s, externalid="ES%d" % s)
+			for a in range(areas):
+				area = self._add('areas', past(), site=s, code="S%d-A%d" % (s, a))
+				area['areacode'] = area['code']
+				for l in range(lines):
+					line = self._add('lines', past(), site=s, code="%s-L%d" % (area['code'], l), area=area['id'], areacode=area['code'])
+					for m in range(machines):
+						machine = self._add('machines', past(), site=s, code="%s-M%d" % (line['code'], m), area=area['id'], areacode=area['code'], line=line['id'], linecode=line['code'])
+						machine['cyclecount'] = rnd.randint(0, 100000)
+
+
+	def _add(self, api, updated, **fields):
+		""" Add a record with the common fields, created and last updated at updated """
+		record = {
+			'id': self.next_id,
+			'externalid': "E%d" % self.next_id,
+			'description': "%s %d" % (api, self.next_id),
+			'active': True,
+			'created': updated.strftime(MOCK_DATETIME_FORMAT),
+			'lastupdated': updated.strftime(MOCK_DATETIME_FORMAT),
+		}
+		record.update(fields)
+		self.next_id += 1
+		self.records[api].append(record)
+		return record
+
+
+	def touch(self, record):
+		""" Mark a record as updated now """
+		record['lastupdated'] = datetime.now().strftime(MOCK_DATETIME_FORMAT)
+
+
+	def query(self, api, parameters):
+		""" Returns the records of a list api matching the parameters """
+		filters = []
+		for key, value in parameters.items():
+			if key in MOCK_RESERVED_PARAMETERS:
+				continue
+			field, op = key, 'eq'
+			if '__' in key:
+				field, op = key.rsplit('__', 1)
+			filters.append((field, op, value))
+
+		offset = int(parameters.get('offset', 0))
+		limit = parameters.get('limit')
+		fields = [f for f in parameters.get('fields', '').split(',') if f]
+		with self.lock:
+			matched = [r for r in self.records[api] if self._match(r, filters)]
+		matched = matched[offset:offset + int(limit)] if limit is not None else matched[offset:]
+		if fields:
+			return [dict((f, r.get(f)) for f in fields) for r in matched]
+		return [dict(r) for r in matched]
+
+
+	def _match(self, record, filters):
+		""" True if the record matches all filters, unknown fields are ignored like the L2L API does """
+		for field, op, value in filters:
+			if field not in record:
+				continue
+			actual = record[field]
+			if isinstance(actual, bool):
+				actual, value = actual, value.lower() in ('1', 'true', 'yes')
+			elif isinstance(actual, (int, long)):
+				try:
+					value = int(value)
+				except ValueError:
+					return False
+			else:
+				actual = unicode(actual)
+			if op == 'eq' and not actual == value: return False
+			if op == 'gt' and not actual > value: return False
+			if op == 'gte' and not actual >= value: return False
+			if op == 'lt' and not actual < value: return False
+			if op == 'lte' and not actual <= value: return False
+		return True
+
+
+	def machine(self, parameters):
+		""" Returns the machine matching the code (and site) parameters, or None """
+		code = parameters.get('code')
+		with self.lock:
+			for record in self.records['machines']:
+				if record['code'] == code and ('site' not in parameters or str(record['site']) == parameters['site']):
+					return record
+		return None
+
+
+class L2L_MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	""" HTTP/1.1 keep-alive request handler for the mock API """
+
+	protocol_version = "HTTP/1.1"
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args):
+		pass
+
+
+	def do_GET(self):
+		self._handle("GET")
+
+
+	def do_POST(self):
+		self._handle("POST")
+
+
+	def _handle(self, method):
+		""" Parse the request, apply latency and injected errors, and dispatch to the api """
+		server = self.server
+		url = urlparse.urlsplit(self.path)
+		parameters = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+		if method == "POST":
+			length = int(self.headers.get('content-length') or 0)
+			body = self.rfile.read(length)
+			if (self.headers.get('content-encoding') or '').lower() == 'gzip':
+				body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+			parameters.update(dict(urlparse.parse_qsl(body, keep_blank_values=True)))
+		api = url.path.split('/api/1.0/', 1)[-1]
+		server.record_call(method, api)
+
+		if server.latency or server.jitter:
+			time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+		if server.throttle_rate and random.random() < server.throttle_rate:
+			return self._send(429, {'success': False, 'error': "Too Many Requests"})
+		if server.error_rate and random.random() < server.error_rate:
+			return self._send(500, {'success': False, 'error': "Internal Server Error"})
+		if server.auth_key is not None and parameters.get('auth') != server.auth_key:
+			return self._send(200, {'success': False, 'error': "Invalid auth key"})
+
+		try:
+			body = self._route(method, api, parameters)
+		except Exception, e:
+			body = {'success': False, 'error': str(e)}
+		if body is None:
+			return self._send(404, {'success': False, 'error': "Unknown api: %s" % api})
+		self._send(200, body)
+
+
+	def _route(self, method, api, parameters):
+		""" Returns the response body for an api, or None for an unknown api """
+		data = self.server.data
+		parts = [p for p in api.split('/') if p]
+		if len(parts) == 1 and parts[0] in MOCK_LIST_APIS:
+			return {'success': True, 'data': data.query(parts[0], parameters)}
+		if len(parts) == 2 and parts[0] in MOCK_LIST_APIS and parts[1].isdigit():
+			records = data.query(parts[0], {'id': parts[1]})
+			if not records:
+				return {'success': False, 'error': "Record not found"}
+			return {'success': True, 'data': records[0]}
+
+		if parts in (['machines', 'increment_cycle_count'], ['machines', 'set_cycle_count']):
+			if method != "POST":
+				return {'success': False, 'error': "POST required"}
+			machine = data.machine(parameters)
+			if machine is None:
+				return {'success': False, 'error': "Machine not found: %s" % parameters.get('code')}
+			with data.lock:
+				if parts[1] == 'increment_cycle_count':
+					machine['cyclecount'] += int(parameters['cyclecount'])
+				else:
+					machine['cyclecount'] = int(parameters['cyclecount'])
+				if not parameters.get('skip_lastupdated'):
+					data.touch(machine)
+				return {'success': True, 'data': dict(machine)}
+
+		if parts == ['pitchdetails', 'record_details']:
+			for field in ('start', 'end', 'productcode'):
+				if not parameters.get(field):
+					return {'success': False, 'error': "Missing parameter: %s" % field}
+			with data.lock:
+				record = dict(parameters)
+				record.pop('auth', None)
+				record['id'] = len(data.pitchdetails) + 1
+				data.pitchdetails.append(record)
+			return {'success': True, 'data': record}
+
+		if parts == ['dispatches', 'open']:
+			if method != "POST":
+				return {'success': False, 'error': "POST required"}
+			machinecode, dispatchtypecode = parameters.get('machinecode'), parameters.get('dispatchtypecode')
+			with data.lock:
+				for record in data.records['dispatches']:
+					if record['open'] and record['machinecode'] == machinecode and record['dispatchtypecode'] == dispatchtypecode:
+						return {'success': False, 'error': MOCK_DUPLICATE_DISPATCH_ERROR.format(machinecode=machinecode, dispatchtypecode=dispatchtypecode)}
+				record = data._add('dispatches', datetime.now(), site=int(parameters.get('site') or 1), machinecode=machinecode, dispatchtypecode=dispatchtypecode,
+						description=parameters.get('description'), tradecode=parameters.get('tradecode'), user=parameters.get('user'), open=True)
+				return {'success': True, 'data': dict(record)}
+
+		if len(parts) == 3 and parts[:2] == ['dispatches', 'close'] and parts[2].isdigit():
+			with data.lock:
+				for record in data.records['dispatches']:
+					if record['id'] == int(parts[2]):
+						record['open'] = False
+						data.touch(record)
+						return {'success': True, 'data': dict(record)}
+			return {'success': False, 'error': "Dispatch not found"}
+		return None
+
+
+	def _send(self, status, body):
+		""" Write a JSON response, compressed when the client accepts it, at the server's bandwidth """
+		payload = json.dumps(body)
+		encoding = None
+		if len(payload) >= MOCK_COMPRESS_MIN_BYTES:
+			accepted = [e.split(';')[0].strip().lower() for e in (self.headers.get('accept-encoding') or '').split(',')]
+			if 'gzip' in accepted:
+				encoding, compressor = 'gzip', zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			elif 'deflate' in accepted:
+				encoding, compressor = 'deflate', zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS)
+			if encoding is not None:
+				payload = compressor.compress(payload) + compressor.flush()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		if encoding is not None:
+			self.send_header('Content-Encoding', encoding)
+		self.send_header('Content-Length', str(len(payload)))
+		self.end_headers()
+		self.server.record_bytes(len(payload))
+		if self.server.bandwidth:
+			time.sleep(len(payload) / float(self.server.bandwidth))
+		self.wfile.write(payload)
+		self.wfile.flush()
+
+
+class L2L_MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	""" Threaded mock L2L API server """
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, data, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, auth_key=None, bandwidth=0):
+		BaseHTTPServer.HTTPServer.__init__(self, address, L2L_MockHandler)
+		self.data = data
+		self.latency = latency
+		self.bandwidth = bandwidth		# Response bytes per second per connection, 0 is unlimited
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.throttle_rate = throttle_rate
+		self.auth_key = auth_key
+		self.url = "http://%s:%d" % self.server_address[:2]
+		self._calls_lock = threading.Lock()
+		self.calls = {}
+		self.bytes_sent = 0
+
+
+	def record_call(self, method, api):
+		""" Count a request per method and api """
+		with self._calls_lock:
+			key = "%s %s" % (method, api)
+			self.calls[key] = self.calls.get(key, 0) + 1
+
+
+	def record_bytes(self, count):
+		""" Count the response body bytes sent """
+		with self._calls_lock:
+			self.bytes_sent += count
+
+
+	def stats(self):
+		""" Returns the request counts per method and api """
+		with self._calls_lock:
+			return dict(self.calls)
+
+
+	def reset_stats(self):
+		""" Clears the request counts and bytes sent """
+		with self._calls_lock:
+			self.calls.clear()
+			self.bytes_sent = 0
+
+
+def start_server(host="127.0.0.1", port=0, sites=1, areas=4, lines=5, machines=10, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, auth_key=None, seed=0, bandwidth=0):
+	""" Start a mock server on a background thread and return it. port=0 picks a free port, see server.url """
+	data = L2L_MockData(sites, areas, lines, machines, seed)
+	server = L2L_MockServer((host, port), data, latency, jitter, error_rate, throttle_rate, auth_key, bandwidth)
+	thread = threading.Thread(target=server.serve_forever, name="L2L-MockServer")
+	thread.daemon = True
+	thread.start()
+	return server
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Offline mock L2L API server")
+	parser.add_argument('--host', default="127.0.0.1")
+	parser.add_argument('--port', type=int, default=8080)
+	parser.add_argument('--sites', type=int, default=1, help="number of sites")
+	parser.add_argument('--areas', type=int, default=4, help="areas per site")
+	parser.add_argument('--lines', type=int, default=5, help="lines per area")
+	parser.add_argument('--machines', type=int, default=10, help="machines per line")
+	parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+	parser.add_argument('--jitter', type=float, default=0.0, help="+/- seconds of random latency")
+	parser.add_argument('--bandwidth', type=int, default=0, help="response bytes per second per connection, 0 is unlimited")
+	parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+	parser.add_argument('--throttle-rate', type=float, default=0.0, help="fraction of requests answered with HTTP 429")
+	parser.add_argument('--auth-key', default=None, help="only accept this auth key, any key is accepted by default")
+	args = parser.parse_args()
+
+	data = L2L_MockData(args.sites, args.areas, args.lines, args.machines)
+	server = L2L_MockServer((args.host, args.port), data, args.latency, args.jitter, args.error_rate, args.throttle_rate, args.auth_key, args.bandwidth)
+	print "L2L mock API listening on %s/api/1.0/ (%d sites, %d machines)" % (server.url, args.sites, len(data.records['machines']))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+####################
+# Offline Test Runner
+# Runs the library's Test_L2L_Connection_Class against the offline mock API server under a plain Python 2.7 interpreter,
+# so the tests do not need a sandbox site or an Ignition Gateway.
+# Command line examples:
+# 		python2 tools/run_tests.py
+# 		python2 tools/run_tests.py test_get_machines test_dispatch_index
+# 		python2 tools/run_tests.py --url http://localhost:8080
+####################
+import argparse
+import logging
+import os
+import sys
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ignition_shim
+import l2l_mock_server
+
+
+# Test data that exists in the default mock dataset, replaces the sandbox TEST_L2L_DATA
+MOCK_TEST_DATA = {
+	'machinecode': "S1-A0-L0-M0",
+	'linecode': "S1-A0-L0",
+	'productcode': "Flange01",
+	'dispatchtypecode': "Code Red",
+	'dispatch_description': "Houston, we have a problem!",
+	'tradecode': "Mechanic",
+}
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Run Test_L2L_Connection_Class against the offline mock API server")
+	parser.add_argument('tests', nargs='*', help="test method names, default run_all_tests")
+	parser.add_argument('--url', default=None, help="use an already running mock server instead of starting one")
+	parser.add_argument('--verbose', action='store_true', help="show the library debug log")
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+	server = None
+	if args.url:
+		url = args.url.rstrip('/')
+	else:
+		server = l2l_mock_server.start_server()
+		url = server.url
+	ignition_shim.redirect(url)
+	L2L = ignition_shim.load_library()
+	L2L.TEST_L2L_DATA.update(MOCK_TEST_DATA)
+
+	tests = L2L.Test_L2L_Connection_Class("mock", "mock", 1, "mock")
+	failed = 0
+	for name in args.tests or ['run_all_tests']:
+		try:
+			getattr(tests, name)()
+			print "PASS %s" % name
+		except:
+			failed += 1
+			traceback.print_exc()
+			print "FAIL %s" % name
+
+	if server is not None:
+		server.shutdown()
+		server.server_close()
+	sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+	main()